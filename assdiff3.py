@@ -2,9 +2,8 @@
 
 import argparse
 import collections
-import collections.abc
-import heapq
-import io
+import difflib
+import functools
 import re
 import sys
 
@@ -22,6 +21,9 @@ parser.add_argument('--script-info', choices=['ours', 'theirs'], default='ours',
                     help="Whether to keep 'our' or 'their' changes for the script info and Aegisub project sections")
 parser.add_argument('--newline', '-n', choices=['LF', 'CRLF'], default='LF',
                     help="Line ending to enforce. Uses LF if left unset.")
+parser.add_argument('--fast-matcher', action='store_true',
+                    help="Align lines with rapidfuzz if it is installed. Much faster on large scripts, "
+                         "but may pair lines differently than the default matcher.")
 args = parser.parse_args()
 
 CONFLICT_LINE = "Comment: 0,0:00:00.00,0:00:00.00,Default,,0,0,0,CONFLICT,{}"
@@ -44,77 +46,117 @@ CONFLICT_MARKERS = {
 
 NEWLINE = args.newline.replace("LF", "\n").replace("CR", "\r")
 
-class ASSLine(collections.abc.Mapping):
-    VALID_TYPES = None
-
-    def __init__(self, line=None, fields=None, source_file=None):
-        self.source_file = source_file
-
-        if line is not None:
-            line_type, line_data = line.split(": ", 1)
-            field_values = line_data.split(",", len(self.FIELDS) - 1)
-            if len(field_values) != len(self.FIELDS):
-                raise ValueError("Malformed line: {}".format(line))
+# inputs with fewer candidate line pairs than this are matched in plain Python
+# even if numba is installed, since importing and compiling the JIT kernel
+# would take longer than the matching itself
+JIT_MIN_MATCH_POINTS = 1000000
 
-            self.fields = dict(zip(self.FIELDS, field_values))
-            self.fields["Type"] = line_type
-        elif fields is not None:
-            self.fields = fields
+EXTRA_INDICES_RE = re.compile(r"^\{((?:=\d+)+)\}(.*)$")
 
+def compile_function(name, source, namespace=None):
+    namespace = dict(namespace or {})
+    exec(source, namespace)
+    return namespace[name]
 
-        if self.VALID_TYPES is not None and self.Type not in self.VALID_TYPES:
-            raise ValueError("Not a valid line type")
+class ASSLine:
+    __slots__ = ('Type', 'source_file')
+    VALID_TYPES = None
+    FIELD_TYPES = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.MERGE_FIELDS = ("Type", *cls.FIELDS)
+
+        # __init__ and __str__ are specialized for the class's fields,
+        # so that parsing and serializing a line only touch its slots directly.
+        # The trailing comma makes single-field classes unpack a 1-tuple.
+        targets = "".join("self.{}, ".format(field) for field in cls.FIELDS)
+        init_source = [
+            "def __init__(self, line=None, fields=None, source_file=None):",
+            "    self.source_file = source_file",
+            "    if line is not None:",
+            "        line_type, separator, line_data = line.partition(': ')",
+            "        if not separator:",
+            "            raise ValueError('Malformed line: {}'.format(line))",
+            "        try:",
+            "            {}= line_data.split(',', {})".format(targets, len(cls.FIELDS) - 1),
+            "        except ValueError:",
+            "            raise ValueError('Malformed line: {}'.format(line)) from None",
+            "        self.Type = line_type",
+            "    elif fields is not None:",
+        ]
+        init_source.extend("        self.{0} = fields['{0}']".format(field)
+                           for field in cls.MERGE_FIELDS)
+        init_source.extend("    self.{0} = {0}_type(self.{0})".format(field)
+                           for field in cls.FIELD_TYPES)
+        if cls.VALID_TYPES is not None:
+            init_source.extend([
+                "    if self.Type not in self.VALID_TYPES:",
+                "        raise ValueError('Not a valid line type')",
+            ])
+        cls.__init__ = compile_function(
+            "__init__", "\n".join(init_source),
+            {"{}_type".format(field): field_type
+             for field, field_type in cls.FIELD_TYPES.items()})
+
+        cls.__str__ = compile_function("__str__", (
+            "def __str__(self):\n"
+            "    return f'{{self.Type}}: {}'\n").format(
+                ",".join("{{self.{}}}".format(field) for field in cls.FIELDS)))
 
     @classmethod
     def merge(cls, a, parent, b):
-        changed_a = {field: value for field, value in a.items()
-                     if value != parent[field]}
-        changed_b = {field: value for field, value in b.items()
-                     if value != parent[field]}
-
-        if len(changed_a.keys() & changed_b.keys()) > 0:
-            return None
-
-        return cls(fields={**parent, **changed_a, **changed_b}, source_file="?")
-
-    def __str__(self):
-        ordered_fields = [str(self[field]) for field in self.FIELDS]
-        return f"{self.Type}: {','.join(ordered_fields)}"
-
-    def __getattr__(self, key):
-        return self.fields[key]
-
-    def __getitem__(self, item):
-        return getattr(self, item)
-
-    def __len__(self):
-        return len(self.fields) + 1
-
-    def __iter__(self):
-        yield "Type"
-        yield from self.fields
+        fields = {}
+        for field in cls.MERGE_FIELDS:
+            value = getattr(parent, field)
+            value_a = getattr(a, field)
+            value_b = getattr(b, field)
+
+            if value_a != value:
+                # a field changed on both sides cannot be merged
+                if value_b != value:
+                    return None
+                value = value_a
+            elif value_b != value:
+                value = value_b
+
+            fields[field] = value
+
+        return cls(fields=fields, source_file="?")
+
+    # lines are modified in place (extradata renumbering, style renames),
+    # so the serialized form is not cached
+    def __eq__(self, other):
+        if not isinstance(other, ASSLine):
+            return NotImplemented
+        return str(self) == str(other)
 
 class DialogueLine(ASSLine):
     FIELDS = ['Layer', 'Start', 'End', 'Style', 'Name', 'MarginL',
               'MarginR', 'MarginV', 'Effect', 'Text']
+    # Text is a property that splits off the extradata indices
+    __slots__ = ('Layer', 'Start', 'End', 'Style', 'Name', 'MarginL',
+                 'MarginR', 'MarginV', 'Effect', '_text', 'extra_indices')
     VALID_TYPES = {"Dialogue", "Comment"}
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.extra_indices = []
-
-        match = re.match(r"^\{((?:=\d+)+)\}(.*)$", self.fields["Text"])
-        if match:
-            self.extra_indices = list(map(int, match.group(1).split("=")[1:]))
-            self.fields["Text"] = match.group(2)
-
     @property
     def Text(self):
         if len(self.extra_indices) > 0:
             return "{{={}}}{}".format("=".join(str(x) for x in self.extra_indices),
-                                      self.fields["Text"])
+                                      self._text)
         else:
-            return self.fields["Text"]
+            return self._text
+
+    @Text.setter
+    def Text(self, value):
+        self.extra_indices = []
+        self._text = value
+
+        # skip the regex for the common case of a line without extradata
+        match = value.startswith("{=") and EXTRA_INDICES_RE.match(value)
+        if match:
+            self.extra_indices = list(map(int, match.group(1).split("=")[1:]))
+            self._text = match.group(2)
 
 
 class StyleLine(ASSLine):
@@ -122,18 +164,18 @@ class StyleLine(ASSLine):
               'OutlineColour', 'BackColour', 'Bold', 'Italic', 'Underline',
               'StrikeOut', 'ScaleX', 'ScaleY', 'Spacing', 'Angle', 'BorderStyle',
               'Outline', 'Shadow', 'Alignment', 'MarginL', 'MarginR', 'MarginV', 'Encoding']
+    __slots__ = tuple(FIELDS)
     VALID_TYPES = {"Style"}
 
 class DataLine(ASSLine):
     FIELDS = ["Id", "Key", "Value"]
+    __slots__ = tuple(FIELDS)
     VALID_TYPES = {"Data"}
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.fields["Id"] = int(self.fields["Id"])
+    FIELD_TYPES = {"Id": int}
 
 class KeyValueLine(ASSLine):
     FIELDS = ["Value"]
+    __slots__ = tuple(FIELDS)
 
 SECTIONS = {
     "Script Info": KeyValueLine,
@@ -145,19 +187,24 @@ SECTIONS = {
 
 def parse_file(fname, indicator=None):
     sections = collections.defaultdict(list)
-    current_section = "?"
+    factory = None
     with open(fname, 'r', encoding='utf-8-sig') as f:
-        for raw_line in f:
-            line = raw_line.strip()
-            section = re.match(r"^\[(.*)\]$", line)
-            if section:
-                current_section = section.group(1)
-            elif len(line) > 0:
-                factory = SECTIONS.get(current_section, lambda x, **kwargs: x)
-                try:
-                    sections[current_section].append(factory(line, source_file=indicator))
-                except ValueError: # ignore unexpected lines
-                    pass
+        # read() already normalizes line endings to \n
+        raw_lines = f.read().split("\n")
+
+    for raw_line in raw_lines:
+        line = raw_line.strip()
+        if line.startswith("[") and line.endswith("]"):
+            current_section = line[1:-1]
+            # lines in sections we don't know about are never used
+            factory = SECTIONS.get(current_section)
+            if factory is not None:
+                section_lines = sections[current_section]
+        elif factory is not None and len(line) > 0:
+            try:
+                section_lines.append(factory(line, source_file=indicator))
+            except ValueError: # ignore unexpected lines
+                pass
 
     return sections
 
@@ -199,24 +246,87 @@ def merge_extradata(mine, parent, their):
     for f in (parent, mine, their):
         id_map = {}
         for data_line in f["Aegisub Extradata"]:
-            original_id = data_line.Id
-            if (data_line.Key, data_line.Value) in extradata_to_id:
-                data_line.Id = extradata_to_id[(data_line.Key, data_line.Value)]
-            else:
-                if data_line.Id in id_to_extradata:
-                    data_line.Id = largest_id + 1
+            extradata = (data_line.Key, data_line.Value)
+            new_id = extradata_to_id.get(extradata)
+            if new_id is None:
+                new_id = data_line.Id
+                if new_id in id_to_extradata:
+                    new_id = largest_id + 1
 
-                extradata_to_id[(data_line.Key, data_line.Value)] = data_line.Id
-                id_to_extradata[data_line.Id] = data_line
-                largest_id = max(largest_id, data_line.Id)
+                extradata_to_id[extradata] = new_id
+                id_to_extradata[new_id] = extradata
+                if new_id > largest_id:
+                    largest_id = new_id
 
-            id_map[original_id] = data_line.Id
+            id_map[data_line.Id] = new_id
 
         for dialogue_line in f["Events"]:
             dialogue_line.extra_indices = [id_map[i] for i in dialogue_line.extra_indices
                                            if i in id_map]
 
-    return [id_to_extradata[i] for i in sorted(id_to_extradata)]
+    return [DataLine(fields={"Type": "Data", "Id": i, "Key": key, "Value": value})
+            for i, (key, value) in sorted(id_to_extradata.items())]
+
+
+# The longest matching block between a[ai:aj] and b[bi:bj], written in the
+# subset of Python numba compiles. The indices in b matching a[i] are
+# indices[starts[i]:ends[i]], sorted.
+def longest_match(starts, ends, indices, ai, aj, bi, bj):
+    longest = 0
+    start_a, start_b = ai, bi
+    # match_lengths[j - bi + 1] is the length of the match ending at b[j]
+    # on row match_rows[j - bi + 1]; index 0 stands in for b[bi - 1].
+    # The rows start out below ai - 1 so nothing counts as a previous match.
+    match_lengths = [0] * (bj - bi + 1)
+    match_rows = [ai - 2] * (bj - bi + 1)
+    for i in range(ai, aj):
+        # find the first match point at or past bj, then walk back to bi,
+        # so that each one still sees the previous row's entry before it
+        lo, hi = starts[i], ends[i]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if indices[mid] < bj:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for k in range(lo - 1, starts[i] - 1, -1):
+            slot = indices[k] - bi + 1
+            if slot <= 0:
+                break
+
+            if match_rows[slot - 1] == i - 1:
+                match_length = match_lengths[slot - 1] + 1
+            else:
+                match_length = 1
+            match_lengths[slot] = match_length
+            match_rows[slot] = i
+
+            # on ties, prefer the earliest match in a, then in b
+            if match_length > longest or \
+                    (match_length == longest and start_a == i - match_length + 1):
+                longest = match_length
+                start_a = i - match_length + 1
+                start_b = slot - match_length + bi
+
+    return start_a, start_b, longest
+
+@functools.lru_cache(maxsize=None)
+def rapidfuzz_indel():
+    try:
+        from rapidfuzz.distance import Indel
+    except ImportError:
+        print("rapidfuzz is not installed, ignoring --fast-matcher", file=sys.stderr)
+        return None
+    return Indel
+
+@functools.lru_cache(maxsize=None)
+def jit_longest_match():
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba.njit(longest_match)
 
 
 class LineMatcher:
@@ -224,44 +334,95 @@ class LineMatcher:
         self.a = a
         self.b = b
         self.memoizers = memoizers
-        self.index_maps = [{} for _ in self.memoizers]
+        # per memoizer: the interned key of each line in b, the indices in b
+        # of each interned key, and the interned key of each line in a
+        # (-1 if absent from b)
+        self.b_ids = []
+        self.postings = []
+        self.a_ids = []
+
+        for memoizer in self.memoizers:
+            key_to_id = {}
+            b_ids = [key_to_id.setdefault(memoizer(line), len(key_to_id)) for line in b]
+            postings = [[] for _ in key_to_id]
+            for i, key_id in enumerate(b_ids):
+                postings[key_id].append(i)
+
+            self.b_ids.append(b_ids)
+            self.postings.append(postings)
+            self.a_ids.append([key_to_id.get(memoizer(line), -1) for line in a])
+
+        # a single memoizer is matched by difflib or rapidfuzz, never by _lcs
+        if len(self.memoizers) > 1:
+            self._prepare_lcs()
+
+    def _prepare_lcs(self):
+        # the sorted indices in b matching each line in a under any memoizer,
+        # merged and flattened once here rather than on every visit in _lcs;
+        # lines with the same keys share one run of indices, which keeps this
+        # linear in the number of distinct lines for scripts full of repeated text
+        flattened = {}
+        starts, ends, indices = [], [], []
+        for key_ids in zip(*self.a_ids):
+            if key_ids not in flattened:
+                matches = sorted(
+                    {j for postings, key_id in zip(self.postings, key_ids) if key_id >= 0
+                     for j in postings[key_id]})
+                flattened[key_ids] = (len(indices), len(indices) + len(matches))
+                indices.extend(matches)
+
+            start, end = flattened[key_ids]
+            starts.append(start)
+            ends.append(end)
+
+        self.longest_match = None
+        if sum(end - start for start, end in zip(starts, ends)) >= JIT_MIN_MATCH_POINTS:
+            self.longest_match = jit_longest_match()
+
+        if self.longest_match is not None:
+            import numpy
+            starts = numpy.array(starts, dtype=numpy.int64)
+            ends = numpy.array(ends, dtype=numpy.int64)
+            indices = numpy.array(indices, dtype=numpy.int64)
+        else:
+            self.longest_match = longest_match
 
-        for i, line in enumerate(b):
-            for imap, memoizer in zip(self.index_maps, self.memoizers):
-                imap.setdefault(memoizer(line), []).append(i)
+        self.match_starts = starts
+        self.match_ends = ends
+        self.match_indices = indices
 
     def _lcs(self, ai, aj, bi, bj):
-        longest_match = 0
-        start_a, start_b = ai, bi
-        match_lengths = {}
-        for i in range(ai, aj):
-            updated_match_lengths = {}
-            line_a = self.a[i]
-            b_matches = heapq.merge(
-                *(imap.get(memoizer(line_a), [])
-                  for imap, memoizer in zip(self.index_maps, self.memoizers)))
-
-            for j in b_matches:
-                if j < bi:
-                    continue
-                elif j >= bj:
-                    break
-
-                match_length = match_lengths.get(j - 1, 0) + 1
-                updated_match_lengths[j] = match_length
-
-                if match_length > longest_match:
-                    longest_match = match_length
-                    start_a = i - match_length + 1
-                    start_b = j - match_length + 1
-            match_lengths = updated_match_lengths
-
-        return start_a, start_b, longest_match
+        return self.longest_match(self.match_starts, self.match_ends, self.match_indices,
+                                  ai, aj, bi, bj)
 
     def find_matches(self):
         matches = []
         queue = collections.deque()
-        queue.append((0, len(self.a), 0, len(self.b)))
+
+        indel = rapidfuzz_indel() if args.fast_matcher else None
+        if indel is not None:
+            # align on the first memoizer in C, then only search the gaps
+            # between the aligned blocks for matches under the other memoizers;
+            # the zero-length sentinel block only closes the last gap
+            prev_a = prev_b = 0
+            blocks = indel.opcodes(self.a_ids[0], self.b_ids[0]).as_matching_blocks()
+            for start_a, start_b, match_length in blocks:
+                queue.append((prev_a, start_a, prev_b, start_b))
+                if match_length > 0:
+                    matches.append((start_a, start_b, match_length))
+                prev_a, prev_b = start_a + match_length, start_b + match_length
+
+            if len(self.memoizers) == 1:
+                return matches
+        elif len(self.memoizers) == 1:
+            # with a single key per line this is exactly difflib's matching;
+            # drop the zero-length sentinel it appends
+            matcher = difflib.SequenceMatcher(None, self.a_ids[0], self.b_ids[0],
+                                              autojunk=False)
+            return matcher.get_matching_blocks()[:-1]
+        else:
+            queue.append((0, len(self.a), 0, len(self.b)))
+
         while len(queue) > 0:
             ai, aj, bi, bj = queue.popleft()
             if aj - ai <= 0 or bj - bi <= 0:
@@ -392,66 +553,78 @@ def main():
         mine["V4+ Styles"], parent["V4+ Styles"], theirs["V4+ Styles"],
         style_conflict_handler, memoizers=(lambda line: line.Name,)))
 
-    events = list(diff3(mine["Events"], parent["Events"], theirs["Events"],
-                        dialogue_conflict_handler,
-                        memoizers=(lambda line: line.Text,
-                                   lambda line: (line.Start, line.End))))
-
     # sanity check: find duplicate style names and disambiguate
-    seen_styles = {}
-    for line in styles:
-        if line.Name in seen_styles:
-            seen_line = seen_styles[line.Name]
-            seen_line.Name = seen_line.source_file + "$" + seen_line.Name
-            line.Name = line.source_file + "$" + line.Name
-            style_conflict = True
-        else:
-            seen_styles[line.Name] = line
-
+    style_counts = collections.Counter(line.Name for line in styles)
+    duplicate_styles = {name for name, count in style_counts.items() if count > 1}
+    if duplicate_styles:
+        style_conflict = True
+        for line in styles:
+            if line.Name in duplicate_styles:
+                line.Name = line.source_file + "$" + line.Name
+
+        # styles from the same file still share their prefixed name,
+        # so number every repeat after the first
+        taken = {line.Name for line in styles}
+        seen = set()
+        for line in styles:
+            if line.Name in seen:
+                number = 2
+                while "{}#{}".format(line.Name, number) in taken:
+                    number += 1
+                line.Name = "{}#{}".format(line.Name, number)
+                taken.add(line.Name)
+            seen.add(line.Name)
+
+    # events are serialized as they come out of diff3, so that only their
+    # strings are kept around until the output is written
+    events = []
+    used_extradata = set()
     if style_conflict:
-        events.insert(0, DialogueLine(
-            CONFLICT_LINE.format(
-                "Style conflict detected. Please resolve the conflict "
-                "through the style manager.")))
+        events.append(CONFLICT_LINE.format(
+            "Style conflict detected. Please resolve the conflict "
+            "through the style manager."))
+
+    for line in diff3(mine["Events"], parent["Events"], theirs["Events"],
+                      dialogue_conflict_handler,
+                      memoizers=(lambda line: line.Text,
+                                 lambda line: (line.Start, line.End))):
+        used_extradata.update(line.extra_indices)
+        events.append(str(line))
+
+    if used_extradata:
+        extradata = [line for line in extradata if line.Id in used_extradata]
+    else:
+        extradata = []
 
-    used_extradata = {i for line in events for i in line.extra_indices}
-    extradata = [line for line in extradata if line.Id in used_extradata]
+    output = ["[Script Info]"]
+    output.extend(str(line) for line in script_info)
+    output.append("")
 
-    output = io.StringIO()
+    if len(project_garbage) > 0:
+        output.append("[Aegisub Project Garbage]")
+        output.extend(str(line) for line in project_garbage)
+        output.append("")
 
-    output.write("[Script Info]\n")
-    for line in script_info:
-        output.write(str(line) + "\n")
-    output.write("\n")
+    output.append("[V4+ Styles]")
+    output.append("Format: {}".format(", ".join(StyleLine.FIELDS)))
+    output.extend(str(line) for line in styles)
+    output.append("")
 
-    if len(project_garbage) > 0:
-        output.write("[Aegisub Project Garbage]\n")
-        for line in project_garbage:
-            output.write(str(line) + "\n")
-        output.write("\n")
-
-    output.write("[V4+ Styles]\n")
-    output.write("Format: {}".format(", ".join(StyleLine.FIELDS)) + "\n")
-    for line in styles:
-        output.write(str(line) + "\n")
-    output.write("\n")
-
-    output.write("[Events]\n")
-    output.write("Format: {}".format(", ".join(DialogueLine.FIELDS)) + "\n")
-    for line in events:
-        output.write(str(line) + "\n")
+    output.append("[Events]")
+    output.append("Format: {}".format(", ".join(DialogueLine.FIELDS)))
+    output.extend(events)
 
     if len(extradata) > 0:
-        output.write("\n")
-        output.write("[Aegisub Extradata]\n")
-        for line in extradata:
-            output.write(str(line) + "\n")
+        output.append("")
+        output.append("[Aegisub Extradata]")
+        output.extend(str(line) for line in extradata)
 
+    # encode the whole file at once and bypass the text layer
     if args.output is None:
-        sys.stdout.buffer.write(output.getvalue().encode('utf-8-sig'))
+        sys.stdout.buffer.write(("\n".join(output) + "\n").encode('utf-8-sig'))
     else:
-        with open(args.output, 'w', encoding='utf-8-sig', newline=NEWLINE) as f:
-            f.write(output.getvalue())
+        with open(args.output, 'wb') as f:
+            f.write((NEWLINE.join(output) + NEWLINE).encode('utf-8-sig'))
 
     if dialogue_conflict or style_conflict:
         sys.exit(1)
@@ -3,7 +3,12 @@
 STATUS=0
 for i in tests/*; do
     echo -e "==== Running test $i ====\n"
-    diff <(python assdiff3.py "$i/A.ass" "$i/O.ass" "$i/B.ass") "$i/result.ass"
+    # extra command line options for this test, e.g. --fast-matcher
+    ARGS=()
+    if [ -f "$i/args" ]; then
+        read -r -a ARGS < "$i/args"
+    fi
+    diff <(python assdiff3.py "${ARGS[@]}" "$i/A.ass" "$i/O.ass" "$i/B.ass") "$i/result.ass"
     if [ $? -ne 0 ]; then
         STATUS=1
         echo -e "\n!!!! TEST FAILED !!!!\n"
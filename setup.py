@@ -4,6 +4,10 @@ setup(
     name='assdiff3',
     version='0.0.1',
     py_modules=['assdiff3'],
+    extras_require={
+        "fast": ["rapidfuzz"],
+        "jit": ["numba"]
+    },
     entry_points={
         "console_scripts": ["assdiff3=assdiff3:main"]
     }